@@ -1,16 +1,51 @@
 #!/usr/bin/env python3
 import argparse
 import gzip
+import heapq
 import json
 import logging
+import mmap
 import os
 import re
 import sys
-from collections import defaultdict, namedtuple
+from array import array
+from collections import namedtuple
 from datetime import date, datetime
+from functools import lru_cache, partial
+from operator import itemgetter
 from statistics import median
-from string import Template
-from typing import AnyStr, Dict, List, Match, Optional, Tuple, Union
+from typing import (
+    AnyStr,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Match,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEFAULT_CONFIG = {"REPORT_SIZE": 1000, "REPORT_DIR": "./reports", "LOG_DIR": "./log"}
 ConfigType = Dict[str, Union[str, int]]
@@ -18,6 +53,20 @@ ReportDataType = List[Dict[str, Union[str, int, float]]]
 LogMetadata = namedtuple(
     "LogMetadata", ("path_to_file", "file_name", "file_date", "file_extension")
 )
+LogRecords = namedtuple("LogRecords", ("urls", "url_ids", "request_times"))
+UrlStats = namedtuple("UrlStats", ("count", "time_sum", "time_max", "time_med"))
+LOG_FILE_NAME_PATTERN = re.compile(
+    r"nginx-access-ui\.log-(?P<date>\d{8})(?P<extension>\.gz|)"
+)
+LOG_RECORD_PATTERN = re.compile(
+    rb'"(?:POST|GET|HEAD|PUT|OPTIONS) +(?P<url>\S+) +HTTP/\d\.\d" \d+ \d+ '
+    rb'(?:"[^"\n]*" ){5}(?P<request_time>\d+\.\d+)$',
+    re.MULTILINE,
+)
+LOG_CHUNK_SIZE = 4 << 20
+PARTITION_MEDIAN_MIN_SIZE = 32
+REPORT_TABLE_PLACEHOLDER = b"$table_json"
+Buffer = Union[bytes, mmap.mmap]
 
 
 def parse_args():
@@ -28,12 +77,24 @@ def parse_args():
     return parser.parse_args()
 
 
+def loads_json(data: bytes):
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def dumps_json(obj) -> bytes:
+    if orjson is None:
+        return json.dumps(obj).encode("utf-8")
+    return orjson.dumps(obj)
+
+
 def parse_config(config_path: str, default_config: ConfigType) -> ConfigType:
     if not os.path.exists(config_path):
         raise FileNotFoundError("Invalid config.json path")
     try:
-        with open(config_path, "r") as f:
-            config = json.load(f)
+        with open(config_path, "rb") as f:
+            config = loads_json(f.read())
     except json.JSONDecodeError as err:
         raise Exception(f"Unable to decode JSON: {err}")
     if not config:
@@ -54,7 +115,9 @@ def set_logging(config: ConfigType) -> None:
 def parse_log_filename(match: Optional[Match[AnyStr]]) -> Tuple[Optional[date], str]:
     file_date_str, file_extension = tuple(match.groupdict().values())
     try:
-        file_date = datetime.strptime(file_date_str, "%Y%m%d").date()
+        file_date = date(
+            int(file_date_str[0:4]), int(file_date_str[4:6]), int(file_date_str[6:8])
+        )
     except ValueError:
         logging.info(f"Unable to parse date from {file_date_str}")
         file_date = None
@@ -62,26 +125,24 @@ def parse_log_filename(match: Optional[Match[AnyStr]]) -> Tuple[Optional[date],
 
 
 def get_latest_log(log_directory: str) -> Optional[LogMetadata]:
-    file_name_pattern = re.compile(
-        r"nginx-access-ui\.log-(?P<date>\d{8})(?P<extension>\.gz|$)"
-    )
     latest_log = None
     latest_date = datetime.min.date()
-    for log_file in os.listdir(log_directory):
-        match = file_name_pattern.search(log_file)
-        if not match:
-            continue
-        file_date, file_extension = parse_log_filename(match)
-        if not file_date:
-            continue
-        if file_date > latest_date:
-            latest_date = file_date
-            latest_log = LogMetadata(
-                path_to_file=os.path.join(log_directory, log_file),
-                file_name=log_file,
-                file_date=latest_date,
-                file_extension=file_extension,
-            )
+    with os.scandir(log_directory) as entries:
+        for entry in entries:
+            match = LOG_FILE_NAME_PATTERN.fullmatch(entry.name)
+            if not match:
+                continue
+            file_date, file_extension = parse_log_filename(match)
+            if not file_date:
+                continue
+            if file_date > latest_date:
+                latest_date = file_date
+                latest_log = LogMetadata(
+                    path_to_file=entry.path,
+                    file_name=entry.name,
+                    file_date=latest_date,
+                    file_extension=file_extension,
+                )
     return latest_log
 
 
@@ -91,46 +152,162 @@ def build_report_path(report_directory: str, file_date: date) -> str:
     return os.path.join(report_directory, report_name)
 
 
-def parse_log_records(
-    log_metadata: LogMetadata, error_threshold: float
-) -> Dict[str, List[float]]:
-    func = gzip.open if log_metadata.file_extension == ".gz" else open
-    with func(log_metadata.path_to_file, "rb") as f:
-        pattern = re.compile(
-            r'(?:POST|GET|HEAD|PUT|OPTIONS)\s+(?P<url>.+)\s+HTTP\/\d\.\d"\s.+\s'
-            r"(?P<request_time>\d+\.\d+)$"
+def open_log(log_metadata: LogMetadata) -> BinaryIO:
+    if log_metadata.file_extension != ".gz":
+        return open(log_metadata.path_to_file, "rb")
+    if rapidgzip is not None:
+        return rapidgzip.open(log_metadata.path_to_file, parallelization=os.cpu_count())
+    return gzip.open(log_metadata.path_to_file, "rb")
+
+
+def iter_log_buffers(f: BinaryIO, log_metadata: LogMetadata) -> Iterator[Buffer]:
+    if log_metadata.file_extension == ".gz":
+        tail = b""
+        for chunk in iter(partial(f.read, LOG_CHUNK_SIZE), b""):
+            chunk = tail + chunk
+            lines_end = chunk.rfind(b"\n") + 1
+            tail = chunk[lines_end:]
+            if lines_end:
+                yield chunk[:lines_end]
+        if tail:
+            yield tail
+        return
+    if os.fstat(f.fileno()).st_size == 0:
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield buffer
+
+
+def count_lines(buffer: Buffer) -> int:
+    if isinstance(buffer, mmap.mmap):
+        line_breaks_count = sum(
+            buffer[i : i + LOG_CHUNK_SIZE].count(b"\n")
+            for i in range(0, len(buffer), LOG_CHUNK_SIZE)
         )
-        data = defaultdict(list)
-        total_lines_count = 0
-        total_failed_lines_count = 0
-        for line_idx, line in enumerate(f, start=1):
-            record = line.decode("utf-8")
-            match = re.search(pattern, record)
-            if not match:
-                total_failed_lines_count += 1
-                continue
-            url, request_time = tuple(match.groupdict().values())
-            data[url].append(float(request_time))
-            total_lines_count += 1
-        failed_lines_ratio = total_failed_lines_count / total_lines_count
-        if failed_lines_ratio > error_threshold:
-            raise Exception(
-                f"Unable to parse log file. High failed lines ratio: {failed_lines_ratio}"
+    else:
+        line_breaks_count = buffer.count(b"\n")
+    return line_breaks_count + (buffer[-1:] not in (b"", b"\n"))
+
+
+def collect_log_records(
+    buffer: Buffer,
+    url_ids_by_url: Dict[bytes, int],
+    url_ids: array,
+    raw_request_times: bytearray,
+) -> None:
+    for match in LOG_RECORD_PATTERN.finditer(buffer):
+        url, request_time = match.groups()
+        url_ids.append(url_ids_by_url.setdefault(url, len(url_ids_by_url)))
+        raw_request_times += request_time
+        raw_request_times += b"\n"
+
+
+def parse_request_times(raw_request_times: bytearray) -> Sequence[float]:
+    if np is None:
+        return array("d", map(float, raw_request_times.split()))
+    return np.fromstring(bytes(raw_request_times), sep="\n")
+
+
+def parse_log_records(log_metadata: LogMetadata, error_threshold: float) -> LogRecords:
+    url_ids_by_url = {}
+    url_ids = array("i")
+    raw_request_times = bytearray()
+    total_lines_count = 0
+    with open_log(log_metadata) as f:
+        for buffer in iter_log_buffers(f, log_metadata):
+            total_lines_count += count_lines(buffer)
+            collect_log_records(buffer, url_ids_by_url, url_ids, raw_request_times)
+    total_failed_lines_count = total_lines_count - len(url_ids)
+    failed_lines_ratio = (
+        total_failed_lines_count / total_lines_count if total_lines_count else 0.0
+    )
+    if failed_lines_ratio > error_threshold:
+        raise Exception(
+            f"Unable to parse log file. High failed lines ratio: {failed_lines_ratio}"
+        )
+    return LogRecords(
+        urls=[url.decode("utf-8") for url in url_ids_by_url],
+        url_ids=url_ids,
+        request_times=parse_request_times(raw_request_times),
+    )
+
+
+def _partition_median(times):
+    middle = times.size // 2
+    partitioned = np.partition(times, middle)
+    if times.size % 2:
+        return partitioned[middle]
+    return 0.5 * (partitioned[middle] + partitioned[:middle].max())
+
+
+def _median(times):
+    if times.size < PARTITION_MEDIAN_MIN_SIZE:
+        return median(times.tolist())
+    return _partition_median(times)
+
+
+def _group_medians(sorted_times, offsets, counts):
+    medians = np.empty(counts.size)
+    for i in range(counts.size):
+        medians[i] = _median(sorted_times[offsets[i] : offsets[i] + counts[i]])
+    return medians
+
+
+if njit is not None:
+    _jit_partition_median = njit(cache=True)(_partition_median)
+
+    @njit(cache=True)
+    def _jit_group_medians(sorted_times, offsets, counts):
+        medians = np.empty(counts.size)
+        for i in range(counts.size):
+            medians[i] = _jit_partition_median(
+                sorted_times[offsets[i] : offsets[i] + counts[i]]
             )
-        return data
+        return medians
 
 
-def build_report_object(url_stats: Dict[str, List[float]]) -> ReportDataType:
-    report_data = []
-    count_total = sum(len(request_times) for _, request_times in url_stats.items())
-    time_sum_total = sum(
-        request_time
-        for _, request_times in url_stats.items()
-        for request_time in request_times
+def aggregate_url_stats(log_records: LogRecords, use_numba: bool = False) -> UrlStats:
+    if np is None:
+        grouped_times = [[] for _ in log_records.urls]
+        for url_id, request_time in zip(log_records.url_ids, log_records.request_times):
+            grouped_times[url_id].append(request_time)
+        return UrlStats(
+            count=[len(times) for times in grouped_times],
+            time_sum=[sum(times) for times in grouped_times],
+            time_max=[max(times) for times in grouped_times],
+            time_med=[median(times) for times in grouped_times],
+        )
+    url_ids = np.asarray(log_records.url_ids)
+    request_times = np.asarray(log_records.request_times)
+    counts = np.bincount(url_ids, minlength=len(log_records.urls))
+    time_sums = np.bincount(
+        url_ids, weights=request_times, minlength=len(log_records.urls)
     )
-    for url, request_times in url_stats.items():
-        count_url = len(request_times)
-        time_sum_url = sum(request_times)
+    sorted_times = request_times[np.argsort(url_ids, kind="stable")]
+    offsets = np.cumsum(counts) - counts
+    if use_numba and njit is None:
+        logging.info("numba is not installed, computing medians with numpy")
+    group_medians = (
+        _jit_group_medians if use_numba and njit is not None else _group_medians
+    )
+    return UrlStats(
+        count=counts.tolist(),
+        time_sum=time_sums.tolist(),
+        time_max=np.maximum.reduceat(sorted_times, offsets).tolist(),
+        time_med=group_medians(sorted_times, offsets, counts).tolist(),
+    )
+
+
+def build_report_object(
+    log_records: LogRecords, use_numba: bool = False
+) -> ReportDataType:
+    report_data = []
+    url_stats = aggregate_url_stats(log_records, use_numba=use_numba)
+    count_total = len(log_records.url_ids)
+    time_sum_total = sum(url_stats.time_sum)
+    for url_id, url in enumerate(log_records.urls):
+        count_url = url_stats.count[url_id]
+        time_sum_url = url_stats.time_sum[url_id]
         obj = {
             "url": url,
             "count": count_url,
@@ -138,16 +315,25 @@ def build_report_object(url_stats: Dict[str, List[float]]) -> ReportDataType:
             "time_sum": round(time_sum_url, 3),
             "time_perc": round(time_sum_url / time_sum_total * 100, 3),
             "time_avg": round(time_sum_url / count_url, 3),
-            "time_max": sorted(request_times, reverse=False)[-1],
-            "time_med": round(median(request_times), 3),
+            "time_max": url_stats.time_max[url_id],
+            "time_med": round(url_stats.time_med[url_id], 3),
         }
         report_data.append(obj)
     return report_data
 
 
 def filter_report(report_data: ReportDataType, report_size: int) -> ReportDataType:
-    final_report_data = sorted(report_data, key=lambda x: x["time_sum"], reverse=True)
-    return final_report_data[:report_size]
+    return heapq.nlargest(report_size, report_data, key=itemgetter("time_sum"))
+
+
+@lru_cache(maxsize=4)
+def load_report_template(path_to_template: str, mtime_ns: int) -> Tuple[bytes, bytes]:
+    with open(path_to_template, "rb") as f:
+        template_parts = f.read().split(REPORT_TABLE_PLACEHOLDER, 1)
+    if len(template_parts) != 2:
+        raise Exception("Report template has no $table_json placeholder")
+    head, tail = template_parts
+    return head, tail
 
 
 def dump_final_report(
@@ -155,11 +341,13 @@ def dump_final_report(
     path_to_report: str,
     report_data: List[Dict[str, Union[str, int, float]]],
 ):
-    with open(path_to_template, "r") as f:
-        template = Template(f.read())
-    report = template.safe_substitute(table_json=json.dumps(report_data))
-    with open(path_to_report, "w") as f:
-        f.write(report)
+    head, tail = load_report_template(
+        path_to_template, os.stat(path_to_template).st_mtime_ns
+    )
+    with open(path_to_report, "wb") as f:
+        f.write(head)
+        f.write(dumps_json(report_data))
+        f.write(tail)
 
 
 def main(default_config: ConfigType):
@@ -176,11 +364,13 @@ def main(default_config: ConfigType):
             f"Report for the latest date {log_metadata.file_date} already exists"
         )
     error_threshold = config.get("ERROR_THRESHOLD", 0.1)
-    url_stats = parse_log_records(log_metadata, error_threshold=error_threshold)
-    if not url_stats:
+    log_records = parse_log_records(log_metadata, error_threshold=error_threshold)
+    if not log_records.urls:
         logging.info("Unable to generate report: no related records found")
         sys.exit(0)
-    report_data = build_report_object(url_stats)
+    report_data = build_report_object(
+        log_records, use_numba=config.get("USE_NUMBA", False)
+    )
     final_report_data = filter_report(report_data, config["REPORT_SIZE"])
     path_to_template = os.path.join(config["REPORT_DIR"], "report.html")
     dump_final_report(path_to_template, path_to_report, final_report_data)
@@ -1,11 +1,24 @@
+import gzip
 import json
 import os.path
+import tempfile
 import unittest
+from array import array
+from contextlib import contextmanager
 from datetime import datetime
+from statistics import median
+from types import SimpleNamespace
+from unittest import mock
 
 import log_analyzer
 
 
+@contextmanager
+def open_log_buffers(log_metadata: log_analyzer.LogMetadata):
+    with log_analyzer.open_log(log_metadata) as f:
+        yield log_analyzer.iter_log_buffers(f, log_metadata)
+
+
 class TestLogAnalyzer(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -20,7 +33,13 @@ class TestLogAnalyzer(unittest.TestCase):
             file_extension="",
             file_date=datetime(2021, 12, 25).date(),
         )
-        self.test_url_stats = {"test.com": [0.39, 0.133, 0.199, 0.704]}
+        with open(self.test_log_metadata.path_to_file, "rb") as f:
+            self.test_log_data = f.read()
+        self.test_log_records = log_analyzer.LogRecords(
+            urls=["test.com"],
+            url_ids=array("i", [0, 0, 0, 0]),
+            request_times=array("d", [0.39, 0.133, 0.199, 0.704]),
+        )
         self.test_report_data = [
             {
                 "count": 4,
@@ -34,6 +53,28 @@ class TestLogAnalyzer(unittest.TestCase):
             }
         ]
 
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+
+    def _write_log(self, data: bytes, gz: bool = False) -> log_analyzer.LogMetadata:
+        file_extension = ".gz" if gz else ""
+        file_name = self.test_log_metadata.file_name + file_extension
+        path_to_file = os.path.join(self.tmp_dir, file_name)
+        with (gzip.open if gz else open)(path_to_file, "wb") as f:
+            f.write(data)
+        return self.test_log_metadata._replace(
+            path_to_file=path_to_file,
+            file_name=file_name,
+            file_extension=file_extension,
+        )
+
+    def assertLogRecordsEqual(self, got, expected):
+        self.assertEqual(got.urls, expected.urls)
+        self.assertEqual(got.url_ids.tolist(), expected.url_ids.tolist())
+        self.assertEqual(got.request_times.tolist(), expected.request_times.tolist())
+
     def test_parse_args(self):
         args = log_analyzer.parse_args()
         self.assertEqual(args.config, "./config.json")
@@ -49,10 +90,35 @@ class TestLogAnalyzer(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             log_analyzer.parse_config(args.config, {})
 
+    def test_parse_config_invalid(self):
+        config_path = os.path.join(self.tmp_dir, "config.json")
+        with open(config_path, "w") as f:
+            f.write("{invalid")
+        with self.assertRaisesRegex(Exception, "Unable to decode JSON"):
+            log_analyzer.parse_config(config_path, {})
+
+    def test_dumps_json(self):
+        got = log_analyzer.dumps_json(self.test_report_data)
+        self.assertEqual(json.loads(got), self.test_report_data)
+
     def test_get_latest_log(self):
         got = log_analyzer.get_latest_log(self.test_dir)
         self.assertEqual(got, self.test_log_metadata)
 
+    def test_parse_log_filename(self):
+        match = log_analyzer.LOG_FILE_NAME_PATTERN.fullmatch(
+            "nginx-access-ui.log-20211225.gz"
+        )
+        got = log_analyzer.parse_log_filename(match)
+        self.assertEqual(got, (self.test_file_date, ".gz"))
+
+    def test_parse_log_filename_invalid_date(self):
+        match = log_analyzer.LOG_FILE_NAME_PATTERN.fullmatch(
+            "nginx-access-ui.log-20211345"
+        )
+        got = log_analyzer.parse_log_filename(match)
+        self.assertEqual(got, (None, ""))
+
     def test_build_report_path(self):
         got = log_analyzer.build_report_path(self.test_dir, self.test_file_date)
         self.assertEqual(got, os.path.join(self.test_dir, "report-2021.12.25.html"))
@@ -61,16 +127,146 @@ class TestLogAnalyzer(unittest.TestCase):
         got = log_analyzer.parse_log_records(
             self.test_log_metadata, error_threshold=0.1
         )
-        self.assertEqual(got, self.test_url_stats)
+        self.assertLogRecordsEqual(got, self.test_log_records)
+
+    def test_parse_log_records_gz(self):
+        log_metadata = self._write_log(self.test_log_data, gz=True)
+        with mock.patch.object(log_analyzer, "rapidgzip", None):
+            got = log_analyzer.parse_log_records(log_metadata, error_threshold=0.1)
+        self.assertLogRecordsEqual(got, self.test_log_records)
+
+    def test_parse_log_records_rapidgzip(self):
+        open_calls = []
+
+        def rapidgzip_open(path_to_file, parallelization):
+            open_calls.append(parallelization)
+            return gzip.open(path_to_file, "rb")
+
+        rapidgzip_stub = SimpleNamespace(open=rapidgzip_open)
+        log_metadata = self._write_log(self.test_log_data, gz=True)
+        with mock.patch.object(log_analyzer, "rapidgzip", rapidgzip_stub):
+            got = log_analyzer.parse_log_records(log_metadata, error_threshold=0.1)
+        self.assertLogRecordsEqual(got, self.test_log_records)
+        self.assertEqual(open_calls, [os.cpu_count()])
+
+    def test_parse_log_records_gz_chunks(self):
+        lines = self.test_log_data.splitlines()
+        lines += [line.replace(b"test.com", b"/api/v2/banner") for line in lines]
+        datasets = {
+            "trailing newline": b"\n".join(lines) + b"\n",
+            "no trailing newline": b"\n".join(lines),
+            "malformed last line": b"\n".join(lines) + b"\nmalformed line",
+        }
+        for name, data in datasets.items():
+            plain_log_metadata = self._write_log(data)
+            gz_log_metadata = self._write_log(data, gz=True)
+            expected = log_analyzer.parse_log_records(plain_log_metadata, 1.0)
+            expected_lines_count = data.count(b"\n") + (not data.endswith(b"\n"))
+            for chunk_size in (1, 7, 100, 333, 4 << 20):
+                with self.subTest(data=name, chunk_size=chunk_size), mock.patch.object(
+                    log_analyzer, "LOG_CHUNK_SIZE", chunk_size
+                ), mock.patch.object(log_analyzer, "rapidgzip", None):
+                    got = log_analyzer.parse_log_records(gz_log_metadata, 1.0)
+                    self.assertLogRecordsEqual(got, expected)
+                    for log_metadata in (plain_log_metadata, gz_log_metadata):
+                        with open_log_buffers(log_metadata) as buffers:
+                            lines_count = sum(map(log_analyzer.count_lines, buffers))
+                        self.assertEqual(lines_count, expected_lines_count)
+
+    def test_parse_log_records_failed_lines(self):
+        log_metadata = self._write_log(self.test_log_data + b"\nmalformed line\n")
+        with self.assertRaisesRegex(Exception, "High failed lines ratio"):
+            log_analyzer.parse_log_records(log_metadata, error_threshold=0.1)
+        got = log_analyzer.parse_log_records(log_metadata, error_threshold=0.5)
+        self.assertLogRecordsEqual(got, self.test_log_records)
+
+    def test_parse_log_records_empty(self):
+        log_metadata = self._write_log(b"")
+        got = log_analyzer.parse_log_records(log_metadata, error_threshold=0.1)
+        self.assertEqual(got.urls, [])
+
+    def test_parse_request_times(self):
+        got = log_analyzer.parse_request_times(bytearray(b"0.390\n0.133\n1\n"))
+        self.assertEqual(got.tolist(), [0.39, 0.133, 1.0])
+
+    def test_aggregate_url_stats(self):
+        got = log_analyzer.aggregate_url_stats(self.test_log_records)
+        self.assertEqual(got.count, [4])
+        self.assertAlmostEqual(got.time_sum[0], 1.426)
+        self.assertEqual(got.time_max, [0.704])
+        self.assertAlmostEqual(got.time_med[0], 0.2945)
+
+    def test_aggregate_url_stats_pure_python(self):
+        with mock.patch.object(log_analyzer, "np", None):
+            got = log_analyzer.aggregate_url_stats(self.test_log_records)
+        self.assertEqual(got.count, [4])
+        self.assertAlmostEqual(got.time_sum[0], 1.426)
+        self.assertEqual(got.time_max, [0.704])
+        self.assertAlmostEqual(got.time_med[0], 0.2945)
+
+    @unittest.skipIf(log_analyzer.np is None, "numpy is not installed")
+    def test_partition_median(self):
+        np = log_analyzer.np
+        odd = np.array([5.0, 1.0, 4.0, 2.0, 3.0])
+        even = np.array([6.0, 1.0, 5.0, 2.0, 4.0, 3.0])
+        self.assertEqual(log_analyzer._partition_median(odd), 3.0)
+        self.assertEqual(log_analyzer._partition_median(even), 3.5)
+        self.assertEqual(odd.tolist(), [5.0, 1.0, 4.0, 2.0, 3.0])
+
+    @unittest.skipIf(log_analyzer.np is None, "numpy is not installed")
+    def test_group_medians(self):
+        np = log_analyzer.np
+        large = [float((i * 37) % 101) for i in range(40)]
+        small = [0.39, 0.133, 0.199, 0.704]
+        sorted_times = np.array(large + small + [1.5])
+        counts = np.array([len(large), len(small), 1])
+        offsets = np.cumsum(counts) - counts
+        self.assertGreaterEqual(len(large), log_analyzer.PARTITION_MEDIAN_MIN_SIZE)
+        got = log_analyzer._group_medians(sorted_times, offsets, counts)
+        self.assertEqual(got[0], median(large))
+        self.assertAlmostEqual(got[1], 0.2945)
+        self.assertEqual(got[2], 1.5)
+
+    @unittest.skipIf(log_analyzer.njit is None, "numba is not installed")
+    def test_aggregate_url_stats_numba(self):
+        got = log_analyzer.aggregate_url_stats(self.test_log_records, use_numba=True)
+        self.assertEqual(got.count, [4])
+        self.assertAlmostEqual(got.time_sum[0], 1.426)
+        self.assertEqual(got.time_max, [0.704])
+        self.assertAlmostEqual(got.time_med[0], 0.2945)
 
     def test_build_report_object(self):
-        got = log_analyzer.build_report_object(self.test_url_stats)
+        got = log_analyzer.build_report_object(self.test_log_records)
         self.assertEqual(got, self.test_report_data)
 
     def test_filter_report(self):
         got = log_analyzer.filter_report(self.test_report_data, 1)
         self.assertEqual(got, self.test_report_data)
 
+    def test_filter_report_top(self):
+        report_data = [{"url": str(i), "time_sum": float(i % 7)} for i in range(20)]
+        got = log_analyzer.filter_report(report_data, 3)
+        self.assertEqual([obj["url"] for obj in got], ["6", "13", "5"])
+
+    def test_load_report_template(self):
+        mtime_ns = os.stat(self.template_dir).st_mtime_ns
+        head, tail = log_analyzer.load_report_template(self.template_dir, mtime_ns)
+        self.assertTrue(head.rstrip().endswith(b"var table ="))
+        self.assertIs(
+            log_analyzer.load_report_template(self.template_dir, mtime_ns)[0], head
+        )
+
+    def test_dump_final_report_no_placeholder(self):
+        path_to_template = os.path.join(self.tmp_dir, "report.html")
+        with open(path_to_template, "w") as f:
+            f.write("<html></html>")
+        path_to_report = os.path.join(self.tmp_dir, "report-2021.12.25.html")
+        with self.assertRaisesRegex(Exception, "no \\$table_json placeholder"):
+            log_analyzer.dump_final_report(
+                path_to_template, path_to_report, self.test_report_data
+            )
+        self.assertFalse(os.path.exists(path_to_report))
+
     def test_dump_final_report(self):
         path_to_report = log_analyzer.build_report_path(
             self.test_dir, self.test_file_date
@@ -80,7 +276,11 @@ class TestLogAnalyzer(unittest.TestCase):
         )
         report_file = os.path.join(self.test_dir, "report-2021.12.25.html")
         self.assertTrue(os.path.exists(report_file))
+        with open(report_file, "r") as f:
+            report = f.read()
         os.remove(report_file)
+        self.assertNotIn("$table_json", report)
+        self.assertIn('"url":"test.com"', report.replace(" ", ""))
 
 
 if __name__ == "__main__":